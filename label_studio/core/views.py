@@ -8,7 +8,6 @@ import logging
 import pandas as pd
 import posixpath
 import mimetypes
-import urllib.request
 import zipfile
 
 from pathlib import Path
@@ -30,6 +29,7 @@ from core.utils.io import find_file
 from core.label_config import generate_time_series_json
 from core.utils.common import collect_versions
 from io_storages.localfiles.models import LocalFilesImportStorage
+from io_storages.pachyderm.utils import ARCHIVE_TIMEOUT, get_session
 from core.feature_flags import all_flags, get_feature_file_path
 
 
@@ -210,9 +210,10 @@ def pachyderm_data(request):
     if path and redirect_url and request.user.is_authenticated:
         content_type, encoding = mimetypes.guess_type(str(path))
         content_type = content_type or 'application/octet-stream'
-        with urllib.request.urlopen(url=redirect_url) as archive:
-            archive = io.BytesIO(archive.read())
-            return RangedFileResponse(request, zipfile.ZipFile(archive).open(path), content_type)
+        with get_session().get(redirect_url, timeout=ARCHIVE_TIMEOUT) as response:
+            response.raise_for_status()
+            archive = io.BytesIO(response.content)
+        return RangedFileResponse(request, zipfile.ZipFile(archive).open(path), content_type)
 
     logging.warning("Not Authenticated")
     return HttpResponseForbidden()
@@ -1,22 +1,28 @@
 """This file and its contents are licensed under the Apache License 2.0. Please see the included NOTICE for copyright information and LICENSE for a copy of the license.
 """
+import atexit
 import json
 import logging
 import signal
 import os
+import queue
+import threading
+import ujson
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from subprocess import run, Popen
-from time import sleep
-from typing import Dict, Optional, Tuple
+from subprocess import Popen
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
 from urllib.parse import urlparse
 
+from core.redis import start_job_async_or_sync
 from django.conf import settings
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
-from pachyderm_sdk import Client
-from pachyderm_sdk.api import pfs
 from rest_framework.exceptions import ValidationError
 
 from io_storages.base_models import (
@@ -26,12 +32,92 @@ from io_storages.base_models import (
       ImportStorageLink,
       ProjectStorageMixin,
 )
+from io_storages.pachyderm.utils import generate_download_url
 from tasks.models import Annotation
 
+if TYPE_CHECKING:
+    from pachyderm_sdk.api import pfs
+
 PFS_DIR = Path("/pfs")
 logger = logging.getLogger(__name__)
 
-clients_cache = {}
+# serialized annotations waiting for upload, bounds memory when serialization outpaces the network
+EXPORT_QUEUE_SIZE = 64
+# stay below the default 20MB gRPC message limit of pachd
+EXPORT_CHUNK_SIZE = 16 * 1024 * 1024
+
+# pachd address => Client, least recently used first
+CLIENTS_CACHE_SIZE = 16
+clients_cache = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def close_client(client):
+    """Release the gRPC channel held by the client, only safe when nothing uses the client anymore"""
+    channel = getattr(client, '_channel', None)
+    if channel is not None:
+        channel.close()
+
+
+@atexit.register
+def close_clients():
+    with _clients_lock:
+        while clients_cache:
+            _, client = clients_cache.popitem(last=False)
+            close_client(client)
+
+
+# validate_connection runs on every storage form validation, don't ask pachd each time.
+# (pachd address, commit uri) => time the commit was seen. Only positive answers are cached:
+# commits are immutable once created, while a missing one may be created a moment later.
+COMMIT_EXISTS_TTL = 5
+COMMIT_EXISTS_CACHE_SIZE = 256
+_commit_exists_cache = {}
+
+
+def commit_exists(client, pachd_address, commit):
+    """Check that the commit exists, skipping the RPC for commits seen less than COMMIT_EXISTS_TTL seconds ago"""
+    key = (pachd_address, str(commit))
+    now = monotonic()
+    seen_at = _commit_exists_cache.get(key)
+    if seen_at is not None and now - seen_at < COMMIT_EXISTS_TTL:
+        return True
+
+    exists = client.pfs.commit_exists(commit)
+    if exists:
+        if len(_commit_exists_cache) >= COMMIT_EXISTS_CACHE_SIZE:
+            _commit_exists_cache.clear()
+        _commit_exists_cache[key] = now
+    else:
+        _commit_exists_cache.pop(key, None)
+    return exists
+
+
+def drain_queue(q):
+    """Drop every item waiting in the queue"""
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+
+class ExportAborted(Exception):
+    """Queued instead of a request to cancel a modify_file stream"""
+
+
+def iter_requests(q):
+    """Yield queued requests until None, raise a queued exception instead of yielding it
+
+    gRPC cancels the call when its request iterator raises, so nothing that was already sent is applied.
+    """
+    while True:
+        request = q.get()
+        if request is None:
+            return
+        if isinstance(request, BaseException):
+            raise request
+        yield request
 
 
 class PachydermMixin(models.Model):
@@ -46,24 +132,47 @@ class PachydermMixin(models.Model):
     )
 
     def get_client(self):
-        if self.pachd_address in clients_cache:
-            return clients_cache[self.pachd_address]
-
-        client = Client.from_pachd_address(pachd_address=str(self.pachd_address))
-        clients_cache[self.pachd_address] = client
+        address = str(self.pachd_address)
+        with _clients_lock:
+            client = clients_cache.get(address)
+            if client is not None:
+                clients_cache.move_to_end(address)
+                return client
+
+        # built outside of the lock: it can authenticate against pachd and would block every other address
+        # imported here to keep grpc and the generated stubs out of the startup of every worker
+        from pachyderm_sdk import Client
+
+        client = Client.from_pachd_address(pachd_address=address)
+        with _clients_lock:
+            # another thread might have created a client for this address in the meantime, share one channel
+            client = clients_cache.setdefault(address, client)
+            clients_cache.move_to_end(address)
+            if len(clients_cache) > CLIENTS_CACHE_SIZE:
+                # evicted clients may still be in use by other threads, let the gc close their channels
+                clients_cache.popitem(last=False)
         return client
 
+    def _from_uri(self, cls, uri):
+        """Parse uri into a pfs object, reusing the previous result while the uri stays the same"""
+        # keyed by class, so the cache holds at most one branch and one commit
+        cache = self.__dict__.setdefault('_pfs_objects', {})
+        cached = cache.get(cls)
+        if cached is None or cached[0] != uri:
+            cached = cache[cls] = (uri, cls.from_uri(uri))
+        return cached[1]
+
     @property
-    def branch(self) -> pfs.Commit:
-        return pfs.Branch.from_uri(
-            f"{self.pach_project}/{self.pach_repo}@{self.pach_branch}"
-        )
+    def branch(self) -> 'pfs.Branch':
+        from pachyderm_sdk.api import pfs
+
+        return self._from_uri(pfs.Branch, f"{self.pach_project}/{self.pach_repo}@{self.pach_branch}")
 
     @property
-    def commit(self) -> pfs.Commit:
-        return pfs.Commit.from_uri(
-            f"{self.pach_project}/{self.pach_repo}@{self.pach_commit}"
-        )
+    def commit(self) -> 'pfs.Commit':
+        from pachyderm_sdk.api import pfs
+
+        return self._from_uri(pfs.Commit, f"{self.pach_project}/{self.pach_repo}@{self.pach_commit}")
 
     def clean(self):
         """
@@ -78,8 +187,7 @@ class PachydermMixin(models.Model):
             self.pach_branch = "master"
         if not self.pach_commit:
             client = self.get_client()
-            branch = pfs.Branch.from_uri(f"{self.pach_repo}@{self.pach_branch}")
-            branch_info = client.pfs.inspect_branch(branch=branch)
+            branch_info = client.pfs.inspect_branch(branch=self.branch)
             self.pach_commit = branch_info.head.id
         super().clean()
 
@@ -87,12 +195,16 @@ class PachydermMixin(models.Model):
         self.clean()
         super().save(force_insert, force_update, using, update_fields)
 
-    def validate_connection(self, client = None):
+    def validate_connection(self, client=None):
         logger.debug('validate_connection')
+        commit_given = bool(self.pach_commit)
         self.clean()
+        # without a commit clean() takes the branch head from pachd, so it exists for sure
+        if not commit_given:
+            return
         if client is None:
             client = self.get_client()
-        if not client.pfs.commit_exists(self.commit):
+        if not commit_exists(client, self.pachd_address, self.commit):
             raise ValidationError(f"Commit {self.commit} does not exist.")
 
 
@@ -100,24 +212,38 @@ class PachydermImportStorageBase(PachydermMixin, ImportStorage):
     url_scheme = 'http'
 
     def iterkeys(self):
+        from pachyderm_sdk.api import pfs
+
         client = self.get_client()
         base = pfs.File(commit=self.commit, path="/")
-        for file_info in client.pfs.list_file(file=base):
-            yield file_info.file.path
+        # walk_file streams the whole tree in one call and reports the type of every entry,
+        # so directories are skipped without inspecting each path separately
+        for file_info in client.pfs.walk_file(file=base):
+            if file_info.file_type == pfs.FileType.FILE:
+                yield file_info.file.path
 
     def get_data(self, key):
+        from pachyderm_sdk.api import pfs
+
         client = self.get_client()
         file = pfs.File(commit=self.commit, path=key)
 
         if self.use_blob_urls:
-            result = run(['pachctl', 'misc', 'generate-download-url', file.as_uri()], capture_output=True)
             data_key = settings.DATA_UNDEFINED_NAME
-            redirect = f"{self.url_scheme}://{self.pachd_address}/archive/{result.stdout.decode().strip()}.zip"
+            redirect = f"{self.url_scheme}://{self.pachd_address}/archive/{generate_download_url(file.as_uri())}.zip"
             archive_path = file.as_uri().replace("@", "/").replace(":", "")
             return {data_key: f'{settings.HOSTNAME}/data/pfs/?redirect={redirect}&d={archive_path}'}
 
+        # drain the gRPC stream into one buffer and decode it with a single C-level call
         with client.pfs.pfs_file(file) as obj:
-            value = json.loads(obj)
+            raw = obj.read()
+        try:
+            value = ujson.loads(raw)
+        except ValueError:
+            raise ValueError(
+                f"Can\'t import JSON-formatted tasks from {key}. If you're trying to import binary objects, "
+                f"perhaps you've forgot to enable \"Treat every bucket object as a source file\" option?")
+
         if not isinstance(value, dict):
             raise ValueError(f"Error on key {key}: For {self.__class__.__name__} your JSON file must be a dictionary with one task.")  # noqa
         return value
@@ -137,21 +263,101 @@ class PachydermImportStorage(ProjectStorageMixin, PachydermImportStorageBase):
 
 class PachydermExportStorage(PachydermMixin, ExportStorage):
 
-    def save_annotation(self, annotation):
-        client = self.get_client()
-        logger.debug(f'Creating new object on {self.__class__.__name__} Storage {self} for annotation {annotation}')
+    def serialize_annotation(self, annotation):
+        """Returns the key that identifies the annotation in storage and the file content"""
+        logger.debug(
+            'Creating new object on %s Storage %s for annotation %s', self.__class__.__name__, self, annotation
+        )
         ser_annotation = self._get_serialized_data(annotation)
-
-        # get key that identifies this object in storage
         key = PachydermExportStorageLink.get_key(annotation)
+        try:
+            data = ujson.dumps(ser_annotation, indent=2, escape_forward_slashes=False)
+        except OverflowError:
+            # ujson only encodes 64 bit ints, don't fail the whole export batch on one wider number
+            data = json.dumps(ser_annotation, indent=2)
+        return key, data.encode('utf-8')
+
+    def save_annotation(self, annotation):
+        client = self.get_client()
+        key, data = self.serialize_annotation(annotation)
 
         # put object into storage
         with client.pfs.commit(branch=self.branch) as commit:
-            commit.put_file_from_bytes(path=key, data=json.dumps(ser_annotation, indent=2).encode('utf-8'))
+            commit.put_file_from_bytes(path=key, data=data)
 
         # Create export storage link
         PachydermExportStorageLink.create(annotation, self)
 
+    def save_annotations(self, annotations, progress=None):
+        """Export annotations in a single commit through one modify_file stream
+
+        Annotations are serialized in this thread (it owns the DB connection)
+        while gRPC uploads the already serialized ones from its own thread.
+        :param progress: called with the number of annotations serialized so far
+        :return: number of exported annotations
+        """
+        from pachyderm_sdk.api import pfs
+
+        client = self.get_client()
+        upload_queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+
+        def send(request):
+            # a failed upload stops consuming requests, don't wait for a free slot forever
+            while True:
+                try:
+                    upload_queue.put(request, timeout=1)
+                    return
+                except queue.Full:
+                    if upload.done():
+                        upload.result()
+                        raise RuntimeError(f'Upload to {self.branch} finished before all annotations were sent')
+
+        exported = 0
+        with client.pfs.commit(branch=self.branch) as commit, ThreadPoolExecutor(max_workers=1) as executor:
+            upload = executor.submit(client.pfs.modify_file, iter_requests(upload_queue))
+            try:
+                send(pfs.ModifyFileRequest(set_commit=commit))
+                for annotation in annotations:
+                    key, data = self.serialize_annotation(annotation)
+                    send(pfs.ModifyFileRequest(delete_file=pfs.DeleteFile(path=key)))
+                    for start in range(0, max(len(data), 1), EXPORT_CHUNK_SIZE):
+                        chunk = data[start:start + EXPORT_CHUNK_SIZE]
+                        send(pfs.ModifyFileRequest(add_file=pfs.AddFile(path=key, raw=chunk)))
+
+                    exported += 1
+                    if progress is not None:
+                        progress(exported)
+            except BaseException:
+                # commit() finishes the commit even on errors: abort the stream instead of ending it,
+                # so the partial export is discarded. The drained queue has room, put_nowait can't block.
+                drain_queue(upload_queue)
+                upload_queue.put_nowait(ExportAborted(f'Export to {self.branch} failed'))
+                raise
+            send(None)
+            upload.result()
+
+        # files are visible only after the commit is finished, create links after that
+        for annotation in annotations:
+            PachydermExportStorageLink.create(annotation, self)
+        return exported
+
+    def save_all_annotations(self):
+        annotations = Annotation.objects.filter(project=self.project)
+        total_annotations = annotations.count()
+        self.info_set_in_progress()
+
+        def progress(annotation_exported):
+            self.info_update_progress(
+                last_sync_count=annotation_exported,
+                total_annotations=total_annotations
+            )
+
+        annotation_exported = self.save_annotations(annotations, progress=progress)
+        self.info_set_completed(
+            last_sync_count=annotation_exported,
+            total_annotations=total_annotations
+        )
+
 
 class PachydermImportStorageLink(ImportStorageLink):
     storage = models.ForeignKey(PachydermImportStorage, on_delete=models.CASCADE, related_name='links')
@@ -161,10 +367,77 @@ class PachydermExportStorageLink(ExportStorageLink):
     storage = models.ForeignKey(PachydermExportStorage, on_delete=models.CASCADE, related_name='links')
 
 
+# project id => time a pachyderm export storage was seen for it. Only positive answers are cached:
+# a stale "no storages" could silently skip exports for a storage created in another process,
+# while a stale "yes" only queues an export job that finds no storages.
+EXPORT_STORAGES_TTL = 10
+EXPORT_STORAGES_CACHE_SIZE = 1024
+_project_export_storages_cache = {}
+
+
+def project_has_export_storages(project_id):
+    """Check for pachyderm export storages without loading the project, skipping the query
+    for projects that were recently seen with one"""
+    now = monotonic()
+    seen_at = _project_export_storages_cache.get(project_id)
+    if seen_at is not None and now - seen_at < EXPORT_STORAGES_TTL:
+        return True
+
+    exists = PachydermExportStorage.objects.filter(project_id=project_id).exists()
+    if exists:
+        if len(_project_export_storages_cache) >= EXPORT_STORAGES_CACHE_SIZE:
+            _project_export_storages_cache.clear()
+        _project_export_storages_cache[project_id] = now
+    else:
+        _project_export_storages_cache.pop(project_id, None)
+    return exists
+
+
+@receiver(post_save, sender=PachydermExportStorage)
+@receiver(post_delete, sender=PachydermExportStorage)
+def reset_project_export_storages_cache(sender, instance, **kwargs):
+    _project_export_storages_cache.pop(instance.project_id, None)
+
+
+# batch of annotation ids saved by this thread in the current transaction and its on_commit callback
+_pending_exports = threading.local()
+
+
+def async_export_annotations_to_pfs(annotation_ids):
+    annotations_by_project = defaultdict(list)
+    for annotation in Annotation.objects.filter(id__in=annotation_ids):
+        annotations_by_project[annotation.project_id].append(annotation)
+
+    for project_id, annotations in annotations_by_project.items():
+        for storage in PachydermExportStorage.objects.filter(project_id=project_id):
+            logger.debug('Export %s annotations to Pachyderm Storage %s', len(annotations), storage)
+            storage.save_annotations(annotations)
+
+
+def export_pending_annotations_to_pfs(annotation_ids):
+    # pachd commits are slow, don't make the request wait for them when rq workers are available
+    start_job_async_or_sync(async_export_annotations_to_pfs, sorted(set(annotation_ids)))
+
+
+def _is_pending_on_commit(connection, func):
+    # run_on_commit entries are (savepoint ids, func[, robust]), rollbacks remove theirs
+    return any(entry[1] is func for entry in connection.run_on_commit)
+
+
 @receiver(post_save, sender=Annotation)
 def export_annotation_to_pfs(sender, instance, **kwargs):
-    project = instance.task.project
-    if hasattr(project, 'io_storages_pachydermexportstorages'):
-        for storage in project.io_storages_pachydermexportstorages.all():
-            logger.debug(f'Export {instance} to Local Storage {storage}')
-            storage.save_annotation(instance)
+    if instance.project_id is not None and project_has_export_storages(instance.project_id):
+        # annotations saved within one transaction are exported together in a single commit:
+        # the first save registers a callback that captures the batch and the next saves join it
+        # while the callback is pending. Once it has run or was dropped by a rollback, a new batch starts,
+        # so ids never leak into another transaction.
+        connection = transaction.get_connection()
+        batch = getattr(_pending_exports, 'batch', None)
+        if batch is not None and _is_pending_on_commit(connection, batch[1]):
+            batch[0].append(instance.id)
+            return
+
+        annotation_ids = [instance.id]
+        flush = partial(export_pending_annotations_to_pfs, annotation_ids)
+        _pending_exports.batch = (annotation_ids, flush)
+        transaction.on_commit(flush)
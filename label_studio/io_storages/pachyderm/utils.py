@@ -0,0 +1,59 @@
+"""This file and its contents are licensed under the Apache License 2.0. Please see the included NOTICE for copyright information and LICENSE for a copy of the license.
+"""
+import atexit
+import http.cookiejar
+import os
+from functools import lru_cache
+from subprocess import run
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts for requests to pachd's archive server
+ARCHIVE_TIMEOUT = (1, 30)
+# seconds to wait for a pachctl call before giving up on it
+PACHCTL_TIMEOUT = 30
+
+_sessions = {}
+
+
+def create_session():
+    session = requests.Session()
+    # the session is shared between users and redirect urls come from requests, never keep cookies
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    # retry only failed connects, a retried read timeout would hold the worker for another ARCHIVE_TIMEOUT
+    adapter = HTTPAdapter(
+        pool_connections=4, pool_maxsize=16, max_retries=Retry(total=3, connect=3, read=0, backoff_factor=0.1)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Returns a keep-alive session shared by all pachyderm HTTP calls of the current process"""
+    key = os.getpid()
+    if key not in _sessions:
+        _sessions[key] = create_session()
+    return _sessions[key]
+
+
+@atexit.register
+def close_sessions():
+    while _sessions:
+        _, session = _sessions.popitem()
+        session.close()
+
+
+@lru_cache(maxsize=4096)
+def generate_download_url(uri):
+    """Returns the archive id for a PFS file uri
+
+    pachyderm_sdk has no API for this, so it shells out to pachctl. The id only encodes the uri,
+    and file uris are pinned to a commit, so results are memoized to skip the fork/exec on repeated calls.
+    """
+    result = run(
+        ['pachctl', 'misc', 'generate-download-url', uri], capture_output=True, check=True, timeout=PACHCTL_TIMEOUT
+    )
+    return result.stdout.decode().strip()
@@ -0,0 +1,468 @@
+import io
+import json
+import pytest
+import requests
+import requests_mock
+import subprocess
+import uuid
+import zipfile
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock
+
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test import TestCase
+from rest_framework.exceptions import ValidationError
+
+from io_storages.pachyderm import models
+from io_storages.pachyderm.models import (
+    ExportAborted, PachydermExportStorage, PachydermExportStorageLink, PachydermImportStorage,
+    async_export_annotations_to_pfs, commit_exists, project_has_export_storages, reset_project_export_storages_cache,
+)
+from io_storages.pachyderm.utils import generate_download_url, get_session
+from tasks.models import Annotation
+from tests.utils import make_project, make_task
+
+# Commit.from_uri only takes uuid4-shaped hex for a commit id, anything else is a branch name
+COMMIT_ID = uuid.uuid4().hex
+
+
+@pytest.fixture
+def pachyderm_caches():
+    with mock.patch.dict(models.clients_cache, clear=True), \
+            mock.patch.dict(models._commit_exists_cache, clear=True), \
+            mock.patch.dict(models._project_export_storages_cache, clear=True):
+        yield
+
+
+@pytest.fixture
+def export_storage(business_client, pachyderm_caches):
+    project = make_project({}, business_client.user, use_ml_backend=False)
+    return PachydermExportStorage.objects.create(
+        project=project, pach_repo='images', pach_branch='master', pach_commit=COMMIT_ID,
+        pachd_address='localhost:30650'
+    )
+
+
+def make_annotations(project, count):
+    task = make_task({'data': {'image': 'pfs://images/1.jpg'}}, project)
+    return [Annotation.objects.create(task=task, project=project, result=[]) for _ in range(count)]
+
+
+@pytest.mark.django_db
+def test_run_on_commit_layout():
+    # export batching reads connection.run_on_commit, pin its layout for the Django version in use
+    connection = transaction.get_connection()
+    kept, rolled_back = mock.Mock(), mock.Mock()
+
+    with transaction.atomic():
+        transaction.on_commit(kept)
+        assert models._is_pending_on_commit(connection, kept)
+    assert models._is_pending_on_commit(connection, kept)
+
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            transaction.on_commit(rolled_back)
+            assert models._is_pending_on_commit(connection, rolled_back)
+            raise RuntimeError('rollback')
+    assert not models._is_pending_on_commit(connection, rolled_back)
+    assert models._is_pending_on_commit(connection, kept)
+
+
+@pytest.mark.django_db
+def test_export_annotations_batched_per_transaction(export_storage):
+    with mock.patch.object(models, 'start_job_async_or_sync') as start_job:
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                annotations = make_annotations(export_storage.project, 3)
+
+    start_job.assert_called_once_with(
+        async_export_annotations_to_pfs, sorted(annotation.id for annotation in annotations)
+    )
+
+
+@pytest.mark.django_db
+def test_export_annotations_skip_rolled_back_transaction(export_storage):
+    with mock.patch.object(models, 'start_job_async_or_sync') as start_job:
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            with pytest.raises(RuntimeError):
+                with transaction.atomic():
+                    make_annotations(export_storage.project, 2)
+                    raise RuntimeError('rollback')
+            # the batch of the rolled back transaction is gone, the next save starts a new one
+            annotations = make_annotations(export_storage.project, 1)
+
+    start_job.assert_called_once_with(async_export_annotations_to_pfs, [annotations[0].id])
+
+
+ARCHIVE_URL = 'http://localhost:30650/archive/abc.zip'
+ARCHIVE_PATH = f'default/images/master={COMMIT_ID}/1.txt'
+
+
+@pytest.mark.django_db
+def test_pachyderm_data_shared_session(business_client):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        zip_file.writestr(ARCHIVE_PATH, 'hello')
+
+    with requests_mock.Mocker() as m:
+        m.get(ARCHIVE_URL, content=archive.getvalue(), headers={'Set-Cookie': 'session=secret'})
+        r = business_client.get('/data/pfs/', {'redirect': ARCHIVE_URL, 'd': ARCHIVE_PATH})
+        assert r.status_code == 200
+        assert b''.join(r.streaming_content) == b'hello'
+
+    assert get_session() is get_session()
+    # the session is shared by all users, it must never keep cookies
+    assert not get_session().cookies
+
+
+@pytest.mark.django_db
+def test_pachyderm_data_archive_error(business_client):
+    with requests_mock.Mocker() as m:
+        m.get(ARCHIVE_URL, status_code=404)
+        with pytest.raises(requests.HTTPError):
+            business_client.get('/data/pfs/', {'redirect': ARCHIVE_URL, 'd': ARCHIVE_PATH})
+
+
+def test_commit_exists_cache(pachyderm_caches):
+    client = mock.MagicMock()
+    client.pfs.commit_exists.return_value = True
+    commit = PachydermExportStorage(pach_project='default', pach_repo='images', pach_commit=COMMIT_ID).commit
+
+    with mock.patch.object(models, 'monotonic', return_value=100):
+        assert commit_exists(client, 'localhost:30650', commit)
+        assert commit_exists(client, 'localhost:30650', commit)
+        assert client.pfs.commit_exists.call_count == 1
+
+        # the same commit on another pachd is a different commit
+        assert commit_exists(client, 'other:30650', commit)
+        assert client.pfs.commit_exists.call_count == 2
+
+    with mock.patch.object(models, 'monotonic', return_value=100 + models.COMMIT_EXISTS_TTL):
+        assert commit_exists(client, 'localhost:30650', commit)
+        assert client.pfs.commit_exists.call_count == 3
+
+
+def test_commit_exists_does_not_cache_missing_commits(pachyderm_caches):
+    client = mock.MagicMock()
+    client.pfs.commit_exists.return_value = False
+    commit = PachydermExportStorage(pach_project='default', pach_repo='images', pach_commit=COMMIT_ID).commit
+
+    with mock.patch.object(models, 'monotonic', return_value=100):
+        assert not commit_exists(client, 'localhost:30650', commit)
+        # the commit was created right after the failed check
+        client.pfs.commit_exists.return_value = True
+        assert commit_exists(client, 'localhost:30650', commit)
+    assert client.pfs.commit_exists.call_count == 2
+
+
+def make_import_storage(**kwargs):
+    return PachydermImportStorage(
+        pach_project='default', pach_repo='images', pach_branch='master', pach_commit=COMMIT_ID,
+        pachd_address='localhost:30650', **kwargs
+    )
+
+
+def test_iterkeys_walks_nested_files():
+    from pachyderm_sdk.api import pfs
+
+    storage = make_import_storage()
+    client = mock.MagicMock()
+    client.pfs.walk_file.return_value = iter([
+        pfs.FileInfo(file=pfs.File(path='/'), file_type=pfs.FileType.DIR),
+        pfs.FileInfo(file=pfs.File(path='/1.json'), file_type=pfs.FileType.FILE),
+        pfs.FileInfo(file=pfs.File(path='/nested/'), file_type=pfs.FileType.DIR),
+        pfs.FileInfo(file=pfs.File(path='/nested/2.json'), file_type=pfs.FileType.FILE),
+    ])
+
+    with mock.patch.object(PachydermImportStorage, 'get_client', return_value=client):
+        assert list(storage.iterkeys()) == ['/1.json', '/nested/2.json']
+    client.pfs.walk_file.assert_called_once_with(file=pfs.File(commit=storage.commit, path='/'))
+
+
+def test_get_client_evicts_least_recently_used(pachyderm_caches):
+    def from_pachd_address(pachd_address):
+        return mock.MagicMock(name=pachd_address)
+
+    with mock.patch.object(models, 'CLIENTS_CACHE_SIZE', 2), \
+            mock.patch('pachyderm_sdk.Client.from_pachd_address', side_effect=from_pachd_address) as create:
+        client_a = PachydermImportStorage(pachd_address='a:30650').get_client()
+        client_b = PachydermImportStorage(pachd_address='b:30650').get_client()
+        # a is used again, so b becomes the least recently used one
+        assert PachydermImportStorage(pachd_address='a:30650').get_client() is client_a
+        PachydermImportStorage(pachd_address='c:30650').get_client()
+
+        assert list(models.clients_cache) == ['a:30650', 'c:30650']
+        assert create.call_count == 3
+        # another thread may still be using the evicted client
+        client_b._channel.close.assert_not_called()
+
+        assert PachydermImportStorage(pachd_address='b:30650').get_client() is not client_b
+        assert list(models.clients_cache) == ['c:30650', 'b:30650']
+
+
+@pytest.mark.parametrize('value', [1.5, 'https://example.com/1.jpg', 2 ** 70])
+def test_serialize_annotation(value):
+    serialized = {'id': 1, 'result': [{'value': {'number': value}}]}
+    storage = PachydermExportStorage(pach_repo='images', pach_commit=COMMIT_ID)
+
+    # ints wider than 64 bits don't fit ujson and go through the stdlib encoder
+    with mock.patch.object(PachydermExportStorage, '_get_serialized_data', return_value=serialized):
+        key, data = storage.serialize_annotation(SimpleNamespace(id=1, task=SimpleNamespace(id=1)))
+
+    assert json.loads(data.decode('utf-8')) == serialized
+
+
+def mock_pfs_file(content):
+    client = mock.MagicMock()
+    client.pfs.pfs_file.return_value.__enter__.return_value.read.return_value = content
+    return client
+
+
+@pytest.mark.django_db
+def test_get_data():
+    from pachyderm_sdk.api import pfs
+
+    storage = make_import_storage()
+    client = mock_pfs_file(b'{"image": "https://example.com/1.jpg"}')
+
+    with mock.patch.object(PachydermImportStorage, 'get_client', return_value=client):
+        assert storage.get_data('/1.json') == {'image': 'https://example.com/1.jpg'}
+    client.pfs.pfs_file.assert_called_once_with(pfs.File(commit=storage.commit, path='/1.json'))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('content, error', [
+    (b'\x89PNG\r\n', "Can't import JSON-formatted tasks from /1.json"),
+    (b'[{"image": "1.jpg"}]', 'your JSON file must be a dictionary with one task'),
+])
+def test_get_data_invalid_json(content, error):
+    storage = make_import_storage()
+
+    with mock.patch.object(PachydermImportStorage, 'get_client', return_value=mock_pfs_file(content)):
+        with pytest.raises(ValueError) as e:
+            storage.get_data('/1.json')
+    assert error in str(e.value)
+
+
+@pytest.fixture
+def download_urls():
+    generate_download_url.cache_clear()
+    with mock.patch('io_storages.pachyderm.utils.run') as run:
+        yield run
+    generate_download_url.cache_clear()
+
+
+def test_generate_download_url_memoized(download_urls):
+    download_urls.return_value = subprocess.CompletedProcess(args=[], returncode=0, stdout=b'abc\n')
+    uri = f'default/images@{COMMIT_ID}:/1.jpg'
+
+    assert generate_download_url(uri) == 'abc'
+    assert generate_download_url(uri) == 'abc'
+    download_urls.assert_called_once()
+    assert download_urls.call_args[0][0][-1] == uri
+
+
+def test_generate_download_url_failure(download_urls):
+    download_urls.side_effect = subprocess.CalledProcessError(1, 'pachctl', stderr=b'not logged in')
+    uri = f'default/images@{COMMIT_ID}:/1.jpg'
+
+    # a failed pachctl call raises instead of returning an empty url, and is not memoized
+    with pytest.raises(subprocess.CalledProcessError):
+        generate_download_url(uri)
+    assert download_urls.call_args[1]['check'] is True
+
+    download_urls.side_effect = None
+    download_urls.return_value = subprocess.CompletedProcess(args=[], returncode=0, stdout=b'abc\n')
+    assert generate_download_url(uri) == 'abc'
+
+
+@pytest.mark.django_db
+def test_get_data_blob_url(settings):
+    storage = make_import_storage(use_blob_urls=True)
+
+    with mock.patch.object(PachydermImportStorage, 'get_client'), \
+            mock.patch.object(models, 'generate_download_url', return_value='abc') as generate:
+        data = storage.get_data('/1.jpg')
+
+    generate.assert_called_once_with(f'default/images@{COMMIT_ID}:/1.jpg')
+    redirect = 'http://localhost:30650/archive/abc.zip'
+    archive_path = f'default/images/{COMMIT_ID}/1.jpg'
+    url = f'{settings.HOSTNAME}/data/pfs/?redirect={redirect}&d={archive_path}'
+    assert data == {settings.DATA_UNDEFINED_NAME: url}
+
+
+def test_pfs_objects_follow_field_changes():
+    storage = make_import_storage()
+    commit, branch = storage.commit, storage.branch
+    assert commit.id == COMMIT_ID
+    assert storage.commit is commit
+    assert storage.branch is branch
+
+    other_commit = uuid.uuid4().hex
+    storage.pach_commit = other_commit
+    storage.pach_branch = 'dev'
+    assert storage.commit is not commit
+    assert storage.commit.id == other_commit
+    assert storage.branch.name == 'dev'
+
+
+@pytest.mark.django_db
+def test_async_export_annotations_to_pfs(export_storage):
+    annotations = make_annotations(export_storage.project, 2)
+
+    with mock.patch.object(PachydermExportStorage, 'save_annotations') as save_annotations:
+        async_export_annotations_to_pfs([annotation.id for annotation in annotations])
+
+    save_annotations.assert_called_once()
+    assert sorted(annotation.id for annotation in save_annotations.call_args[0][0]) == \
+        sorted(annotation.id for annotation in annotations)
+
+
+def test_validate_connection_resolves_branch_head(pachyderm_caches):
+    storage = PachydermImportStorage(pach_repo='images', pachd_address='localhost:30650')
+    client = mock.MagicMock()
+    client.pfs.inspect_branch.return_value.head.id = COMMIT_ID
+
+    with mock.patch.object(PachydermImportStorage, 'get_client', return_value=client):
+        storage.validate_connection()
+
+    assert (storage.pach_project, storage.pach_branch, storage.pach_commit) == ('default', 'master', COMMIT_ID)
+    # the head was just read from pachd, it exists for sure
+    client.pfs.commit_exists.assert_not_called()
+
+
+@pytest.mark.parametrize('exists', [True, False])
+def test_validate_connection_checks_given_commit(pachyderm_caches, exists):
+    storage = make_import_storage()
+    client = mock.MagicMock()
+    client.pfs.commit_exists.return_value = exists
+
+    if exists:
+        storage.validate_connection(client)
+    else:
+        with pytest.raises(ValidationError):
+            storage.validate_connection(client)
+
+    client.pfs.inspect_branch.assert_not_called()
+    client.pfs.commit_exists.assert_called_once_with(storage.commit)
+
+
+@pytest.mark.django_db
+def test_project_has_export_storages_cache(export_storage, django_assert_num_queries):
+    project_id = export_storage.project_id
+    with mock.patch.object(models, 'monotonic', return_value=100):
+        with django_assert_num_queries(1):
+            assert project_has_export_storages(project_id)
+        with django_assert_num_queries(0):
+            assert project_has_export_storages(project_id)
+
+    with mock.patch.object(models, 'monotonic', return_value=100 + models.EXPORT_STORAGES_TTL):
+        with django_assert_num_queries(1):
+            assert project_has_export_storages(project_id)
+
+        # deleting the storage in this process invalidates the cache
+        export_storage.delete()
+        assert not project_has_export_storages(project_id)
+
+
+@pytest.mark.django_db
+def test_project_has_export_storages_created_elsewhere(export_storage):
+    project_id = export_storage.project_id
+    export_storage.delete()
+    assert not project_has_export_storages(project_id)
+
+    # a storage created by another process doesn't reach the receiver of this one
+    post_save.disconnect(reset_project_export_storages_cache, sender=PachydermExportStorage)
+    try:
+        PachydermExportStorage.objects.create(project_id=project_id, pach_repo='images', pach_commit=COMMIT_ID)
+    finally:
+        post_save.connect(reset_project_export_storages_cache, sender=PachydermExportStorage)
+
+    assert project_has_export_storages(project_id)
+
+
+class FakePFS:
+    """Records the modify_file request stream, optionally failing after `fail_after` requests"""
+
+    def __init__(self, commit, fail_after=None):
+        self._commit = commit
+        self.fail_after = fail_after
+        self.requests = []
+        self.error = None
+
+    @contextmanager
+    def commit(self, branch):
+        yield self._commit
+
+    def modify_file(self, requests):
+        try:
+            for request in requests:
+                self.requests.append(request)
+                if self.fail_after is not None and len(self.requests) >= self.fail_after:
+                    raise IOError('pachd is gone')
+        except Exception as e:
+            self.error = e
+            raise
+
+
+@pytest.mark.django_db
+def test_save_annotations_request_stream(export_storage):
+    from pachyderm_sdk.api import pfs
+
+    annotations = make_annotations(export_storage.project, 2)
+    files = {annotations[0].id: b'0123456789', annotations[1].id: b''}
+    pfs_client = FakePFS(export_storage.commit)
+
+    def serialize_annotation(annotation):
+        return f'{annotation.id}.json', files[annotation.id]
+
+    with mock.patch.object(models, 'EXPORT_CHUNK_SIZE', 4), \
+            mock.patch.object(PachydermExportStorage, 'get_client', return_value=SimpleNamespace(pfs=pfs_client)), \
+            mock.patch.object(export_storage, 'serialize_annotation', side_effect=serialize_annotation):
+        progress = mock.Mock()
+        assert export_storage.save_annotations(annotations, progress=progress) == 2
+
+    first, second = [f'{annotation.id}.json' for annotation in annotations]
+    assert pfs_client.requests == [
+        pfs.ModifyFileRequest(set_commit=export_storage.commit),
+        pfs.ModifyFileRequest(delete_file=pfs.DeleteFile(path=first)),
+        pfs.ModifyFileRequest(add_file=pfs.AddFile(path=first, raw=b'0123')),
+        pfs.ModifyFileRequest(add_file=pfs.AddFile(path=first, raw=b'4567')),
+        pfs.ModifyFileRequest(add_file=pfs.AddFile(path=first, raw=b'89')),
+        pfs.ModifyFileRequest(delete_file=pfs.DeleteFile(path=second)),
+        # empty annotations still create their file
+        pfs.ModifyFileRequest(add_file=pfs.AddFile(path=second, raw=b'')),
+    ]
+    assert pfs_client.error is None
+    assert progress.call_args_list == [mock.call(1), mock.call(2)]
+    assert PachydermExportStorageLink.objects.filter(storage=export_storage).count() == 2
+
+
+@pytest.mark.django_db
+def test_save_annotations_upload_failure(export_storage):
+    annotations = make_annotations(export_storage.project, 3)
+    pfs_client = FakePFS(export_storage.commit, fail_after=1)
+
+    with mock.patch.object(PachydermExportStorage, 'get_client', return_value=SimpleNamespace(pfs=pfs_client)):
+        with pytest.raises(IOError, match='pachd is gone'):
+            export_storage.save_annotations(annotations)
+
+    assert not PachydermExportStorageLink.objects.filter(storage=export_storage).exists()
+
+
+@pytest.mark.django_db
+def test_save_annotations_serialization_failure(export_storage):
+    annotations = make_annotations(export_storage.project, 2)
+    pfs_client = FakePFS(export_storage.commit)
+
+    with mock.patch.object(PachydermExportStorage, 'get_client', return_value=SimpleNamespace(pfs=pfs_client)), \
+            mock.patch.object(export_storage, 'serialize_annotation', side_effect=ValueError('broken annotation')):
+        with pytest.raises(ValueError, match='broken annotation'):
+            export_storage.save_annotations(annotations)
+
+    # the stream is aborted rather than ended, so gRPC cancels the call instead of applying a partial export
+    assert isinstance(pfs_client.error, ExportAborted)
+    assert not PachydermExportStorageLink.objects.filter(storage=export_storage).exists()